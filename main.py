@@ -1,13 +1,22 @@
 import asyncio
 import calendar
+import copy
+import cProfile
 import csv
 import datetime
+import functools
+import inspect
 import io
 import itertools
 import json
 import logging
+import logging.handlers
 import concurrent.futures
+import math
+import pstats
+import queue
 import re
+import sys
 import time
 
 import aiosqlite
@@ -17,9 +26,16 @@ import httpx_caching
 import yaml
 from discord.ext import commands
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 config_file = 'config.yml'
 registry_db = 'registry.db'
+lock_file = 'bot.lock'
 fanbox_id_prog = re.compile(r'(\d+)')
+import_pixiv_id_prog = re.compile(r'(?:(?:https?://)?(?:www\.)?pixiv\.net/(?:[a-z]{2}/)?users/)?(\d+)/?')
 periodic_tasks = {}
 
 class obj:
@@ -53,6 +69,85 @@ class RateLimiter:
             self.last_time = time.time()
             return result
 
+class Timings:
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, name, elapsed):
+        count, total, longest = self.stats.get(name, (0, 0.0, 0.0))
+        self.stats[name] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    def timed(self, func):
+        name = func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+        return wrapper
+
+    def report(self):
+        lines = []
+        for name, (count, total, longest) in sorted(self.stats.items()):
+            lines.append(f'{name}: count {count}, total {total:.3f}s, avg {total / count * 1000:.1f}ms, max {longest * 1000:.1f}ms')
+        return '\n'.join(lines)
+
+    def clear(self):
+        self.stats.clear()
+
+timings = Timings()
+
+# How late the event loop wakes up from a sleep. Blocking calls on the loop thread show up here.
+async def monitor_loop_lag(interval=1, warn_seconds=1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - start - interval
+        timings.record('event_loop_lag', lag)
+        if lag > warn_seconds:
+            logging.warning(f'Event loop was blocked for {lag:.2f}s')
+
+class LoopProfiler:
+    def __init__(self):
+        self.profile = None
+
+    def is_running(self):
+        return self.profile is not None
+
+    # Before Python 3.12, cProfile only profiles the thread it's enabled in, which must be the event loop thread.
+    # From 3.12 it records calls from every thread, so the report also includes background
+    # threads like the logging QueueListener.
+    # Returns the new profiling session, which can be passed to stop().
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self.profile
+
+    # When a session is given, the profiler is only stopped if that session is still running,
+    # so a timed run doesn't end a session that was started after it was stopped early.
+    # Returns None when there was nothing to stop.
+    def stop(self, session=None):
+        if self.profile is None or (session is not None and session is not self.profile):
+            return None
+        self.profile.disable()
+        fileobj = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=fileobj)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(100)
+        self.profile = None
+        fileobj.seek(0)
+        return fileobj
+
 class AuthException(Exception):
     pass
 
@@ -104,16 +199,88 @@ def get_fanbox_pixiv_id(message):
         return result.group(1)
     return None
 
-def setup_logging(log_file):
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def make_log_file_handler(log_file, log_settings):
+    # Time based rotation takes precedence over size based rotation when both are set.
+    if log_settings.rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            log_file,
+            when=log_settings.rotate_when,
+            backupCount=log_settings.backup_count,
+            encoding='utf-8',
+            utc=True)
+    return logging.handlers.RotatingFileHandler(
+        log_file,
+        maxBytes=int(log_settings.max_megabytes * 1024 * 1024),
+        backupCount=log_settings.backup_count,
+        encoding='utf-8')
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The default prepare() formats the record before queueing it, which would make the
+    # listener's handlers format it twice and drop exc_info. Records are passed between
+    # threads of the same process, so only the message arguments need to be resolved.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(log_file, log_settings):
+    if log_settings.json:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s')
+    handlers = [make_log_file_handler(log_file, log_settings), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    # Handlers do blocking I/O, so they are run on a background thread and the
+    # event loop only has to put records on a queue.
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
     logging.basicConfig(
-        format='[%(asctime)s][%(levelname)s] %(message)s',
         level=logging.INFO,
-        handlers=[
-            logging.FileHandler(log_file, encoding='utf-8'),
-            logging.StreamHandler()
-        ])
+        handlers=[LogQueueHandler(log_queue)],
+        force=True)
     logging.getLogger('discord').setLevel(logging.WARNING)
     logging.getLogger('httpx').setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+# Collects entries from bursty log sites, like per-member sweep results,
+# and emits them as one line per batch.
+class LogBatch:
+    def __init__(self, label, size=100):
+        self.label = label
+        self.size = size
+        self.entries = []
+
+    def add(self, entry):
+        self.entries.append(entry)
+        if len(self.entries) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.entries:
+            logging.info(f'{self.label}: {len(self.entries)} {self.entries}')
+            self.entries.clear()
+
+default_log_settings = {
+    'max_megabytes': 10,
+    'rotate_when': None,
+    'backup_count': 5,
+    'json': False,
+}
 
 def load_config(config_file):
     with open(config_file, 'r', encoding='utf-8') as f:
@@ -123,6 +290,7 @@ def load_config(config_file):
         config.all_roles = list(config.plan_roles.values())
         config.cleanup = obj(config.cleanup)
         config.auto_role_update = obj(config.auto_role_update)
+        config.log_settings = obj(default_log_settings | (getattr(config, 'log_settings', None) or {}))
         config.session_cookies = str_values(config.session_cookies)
         return config
 
@@ -227,11 +395,12 @@ def compute_highest_plan_id(txns, plan_fee_lookup):
     # Best effort: Get the nearest plan in case there were plan value changes.
     return min(plan_fee_lookup.items(), key=lambda x: abs(highest - x[0]))[1]
 
-async def open_database():
-    db = await aiosqlite.connect(registry_db)
+async def open_database(path=registry_db):
+    db = await aiosqlite.connect(path)
     await db.execute('create table if not exists user_data (pixiv_id integer not null primary key, data text)')
     await db.execute('create table if not exists member_pixiv (member_id integer not null primary key, pixiv_id integer)')
     await db.execute('create table if not exists plan_fee (fee numeric not null primary key, plan text)')
+    await db.execute('create table if not exists import_queue (id integer primary key autoincrement, member_id integer not null, pixiv_id integer not null, status text, unique(member_id, pixiv_id))')
     return db
 
 async def reset_bindings_db(db):
@@ -282,6 +451,122 @@ async def update_plan_fees_db(db, plan_fees):
         await db.execute('replace into plan_fee values(?, ?)', (k, v))
     await db.commit()
 
+async def add_imports_db(db, rows):
+    # Rows from a finished import are only kept around while a job is still pending,
+    # so that re-submitting the same rows resumes the job instead of restarting it.
+    cursor = await db.execute('select count(*) from import_queue where status is null')
+    pending = (await cursor.fetchone())[0]
+    if pending == 0:
+        await db.execute('delete from import_queue')
+    await db.executemany('insert or ignore into import_queue (member_id, pixiv_id) values(?, ?)', rows)
+    await db.commit()
+
+async def retry_import_errors_db(db):
+    await db.execute("update import_queue set status = null where status = 'error'")
+    await db.commit()
+
+async def get_pending_imports_db(db):
+    cursor = await db.execute('select id, member_id, pixiv_id from import_queue where status is null order by id')
+    return await cursor.fetchall()
+
+async def get_imported_members_db(db):
+    cursor = await db.execute("select member_id from import_queue where status = 'bound'")
+    result = await cursor.fetchall()
+    return {r[0] for r in result}
+
+async def get_import_counts_db(db):
+    cursor = await db.execute('select status, count(*) from import_queue group by status')
+    result = await cursor.fetchall()
+    return {r[0]:r[1] for r in result}
+
+def parse_import_pixiv_id(cell):
+    result = import_pixiv_id_prog.fullmatch(cell.strip())
+    if result:
+        return int(result.group(1))
+    return None
+
+def parse_import_csv(text):
+    # Rows are `PIXIV_ID, DISCORD_ID`, the same order as the add-user command.
+    # The Pixiv ID may be a Pixiv profile link. Rows where either cell is not an ID,
+    # like a header, are skipped.
+    rows = []
+    for record in csv.reader(io.StringIO(text)):
+        if len(record) < 2:
+            continue
+        pixiv_id = parse_import_pixiv_id(record[0])
+        discord_id = record[1].strip()
+        if pixiv_id is None or not discord_id.isdigit():
+            continue
+        rows.append((int(discord_id), pixiv_id))
+    return rows
+
+async def run_import(fanbox_client, db, check_access=None, on_bound=None, progress=None, batch_size=20, concurrency=2):
+    # Bindings are written in batches and each row's status is committed with its batch,
+    # so an interrupted import resumes from the first uncommitted batch.
+    # check_access(member_id, user_data) returns the status to record instead of binding
+    # the row, like 'denied', or None to bind it.
+    # Fetches go through the client's rate limiter, so concurrency is kept low to
+    # avoid queueing too far ahead of users requesting access at the same time.
+    rows = await get_pending_imports_db(db)
+    bound_members = await get_imported_members_db(db)
+    fetch_limit = asyncio.Semaphore(concurrency)
+    fetched = {}
+    total = len(rows)
+    done = 0
+
+    async def fetch(pixiv_id):
+        async with fetch_limit:
+            return await fanbox_client.get_user(pixiv_id)
+
+    for i in range(0, total, batch_size):
+        batch = rows[i:i + batch_size]
+        # Duplicate pixiv_ids are only fetched once per import.
+        pixiv_ids = list({pixiv_id for _, _, pixiv_id in batch} - fetched.keys())
+        results = await asyncio.gather(*map(fetch, pixiv_ids), return_exceptions=True)
+        for pixiv_id, result in zip(pixiv_ids, results):
+            if isinstance(result, AuthException):
+                raise result
+            if isinstance(result, Exception):
+                logging.warning(f'Import: failed to fetch pixiv_id {pixiv_id}: {result}')
+                fetched[pixiv_id] = 'error'
+            elif result is None:
+                fetched[pixiv_id] = 'not_found'
+            else:
+                await db.execute('replace into user_data values(?, ?)', (pixiv_id, json.dumps(result)))
+                fetched[pixiv_id] = 'found'
+
+        statuses = []
+        bound = []
+        for row_id, member_id, pixiv_id in batch:
+            status = fetched[pixiv_id]
+            if status == 'found' and check_access is not None:
+                status = await check_access(member_id, await get_user_data_db(db, pixiv_id)) or status
+            if status == 'found':
+                # The first valid pixiv_id listed for a member wins.
+                if member_id in bound_members:
+                    status = 'skipped'
+                else:
+                    await db.execute('replace into member_pixiv values(?, ?)', (member_id, pixiv_id))
+                    bound_members.add(member_id)
+                    bound.append((member_id, pixiv_id))
+                    status = 'bound'
+            statuses.append((status, row_id))
+        await db.executemany('update import_queue set status = ? where id = ?', statuses)
+        await db.commit()
+
+        if on_bound is not None:
+            for member_id, pixiv_id in bound:
+                try:
+                    await on_bound(member_id, pixiv_id)
+                except Exception as ex:
+                    logging.exception(ex)
+
+        done += len(batch)
+        if progress is not None:
+            await progress(done, total)
+
+    return await get_import_counts_db(db)
+
 async def get_plan_fee_lookup(fanbox_client, db):
     cached_plans = await get_plan_fees_db(db)
     latest_plans = await fanbox_client.get_plans()
@@ -298,9 +583,68 @@ def has_role(member, roles):
             return True
     return False
 
-async def main():
-    config = load_config(config_file)
-    setup_logging(config.log_file)
+class BulkResult:
+    def __init__(self, succeeded=None, failed=None):
+        self.succeeded = succeeded or []
+        # Pairs of (target, exception)
+        self.failed = failed or []
+
+    def done(self):
+        return len(self.succeeded) + len(self.failed)
+
+async def run_bulk_operation(targets, operation, concurrency=5, progress=None, progress_interval=2):
+    # Runs operation(target) for every target with bounded concurrency. Failures are
+    # collected instead of raised so that one bad target doesn't stop the rest.
+    result = BulkResult()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run(target):
+        async with limit:
+            try:
+                await operation(target)
+                result.succeeded.append(target)
+            except Exception as ex:
+                result.failed.append((target, ex))
+
+    async def send_progress():
+        try:
+            await progress(result.done(), len(targets))
+        except Exception as ex:
+            logging.exception(ex)
+
+    async def report_progress():
+        while True:
+            await send_progress()
+            await asyncio.sleep(progress_interval)
+
+    reporter = None
+    if progress is not None:
+        reporter = asyncio.create_task(report_progress())
+    try:
+        await asyncio.gather(*map(run, targets))
+    finally:
+        if reporter is not None:
+            # Wait for the reporter to finish cancelling, so an in-flight progress update
+            # can't land after the caller's final summary.
+            reporter.cancel()
+            await asyncio.wait([reporter])
+    if progress is not None:
+        await send_progress()
+    return result
+
+# Runs a bulk operation on guild members, and records the IDs of members that failed
+# in failures[name] so they can be retried.
+async def run_guild_operation(name, targets, operation, failures, progress=None, dry_run=False):
+    # A dry run only previews the targets without making any changes.
+    if dry_run:
+        return BulkResult(succeeded=targets)
+    result = await run_bulk_operation(targets, operation, progress=progress)
+    failures[name] = [member.id for member, _ in result.failed]
+    if result.failed:
+        logging.warning(f'{name}: {len(result.failed)} failed: {[(str(member), str(ex)) for member, ex in result.failed]}')
+    return result
+
+async def main(config):
     rate_limit_table = {}
     intents = discord.Intents.default()
     intents.members = True
@@ -336,6 +680,7 @@ async def main():
             return None
         return config.plan_roles.get(plan['id'])
 
+    @timings.timed
     def compute_role(user_data):
         if user_data is None:
             return None
@@ -352,6 +697,7 @@ async def main():
                 config.only_check_recent_txns)
         return config.plan_roles.get(plan_id)
 
+    @timings.timed
     async def get_fanbox_user_data(pixiv_id, member=None, force_update=False):
         if pixiv_id is None:
             return None
@@ -368,6 +714,7 @@ async def main():
         all_users = await fanbox_client.get_all_users()
         return {int(user['user']['userId']): user['planId'] for user in all_users}
 
+    @timings.timed
     async def set_member_role(member, role):
         if member is None:
             return False
@@ -384,51 +731,69 @@ async def main():
 
     async def update_role_check_by_txn(member:discord.Member):
         if not has_role(member, config.all_roles):
-            return
+            return None
         pixiv_id = await get_member_pixiv_id_db(db, member.id)
         user_data = await get_fanbox_user_data(pixiv_id, member=member)
         role = compute_role(user_data)
         if role is None:
             role = role_from_supporting_plan(user_data)
         if await set_member_role(member, role):
-            logging.info(f'Set role: member: {member} pixiv_id: {pixiv_id} role: {role}')
+            return (str(member), pixiv_id, role.id if role else None)
+        return None
 
+    @timings.timed
     async def update_role_check_all_members_by_txn():
         guild = client.guilds[0]
         logging.info(f'Begin update role check: {guild.member_count} members')
         count = 0
-        async for member in guild.fetch_members(limit=None):
-            try:
-                await update_role_check_by_txn(member)
-                count += 1
-            except AuthException as ex:
-                raise ex
-            except Exception as ex:
-                logging.exception(ex)
+        role_changes = LogBatch('Set roles (member, pixiv_id, role)')
+        # Changes already applied are still logged if the sweep is stopped early.
+        try:
+            async for member in guild.fetch_members(limit=None):
+                try:
+                    change = await update_role_check_by_txn(member)
+                    if change:
+                        role_changes.add(change)
+                    count += 1
+                except AuthException as ex:
+                    raise ex
+                except Exception as ex:
+                    logging.exception(ex)
+        finally:
+            role_changes.flush()
         logging.info(f'End update role check: {count} checked')
 
     async def update_role_check_by_list(member:discord.Member, supporters):
         pixiv_id = await get_member_pixiv_id_db(db, member.id)
         if pixiv_id is None:
-            return
+            return None
         plan_id = supporters.get(pixiv_id)
         role = config.plan_roles.get(plan_id)
         if await set_member_role(member, role):
-            logging.info(f'Set role: member: {member} pixiv_id: {pixiv_id} role: {role}')
+            return (str(member), pixiv_id, role.id if role else None)
+        return None
 
+    @timings.timed
     async def update_role_check_all_members_by_list():
         guild = client.guilds[0]
         logging.info(f'Begin update role check: {guild.member_count} members')
         count = 0
+        role_changes = LogBatch('Set roles (member, pixiv_id, role)')
         all_fanbox_users = await get_all_fanbox_users()
-        async for member in guild.fetch_members(limit=None):
-            try:
-                await update_role_check_by_list(member, all_fanbox_users)
-                count += 1
-            except AuthException as ex:
-                raise ex
-            except Exception as ex:
-                logging.exception(ex)
+        # Changes already applied are still logged if the sweep is stopped early.
+        try:
+            async for member in guild.fetch_members(limit=None):
+                try:
+                    change = await update_role_check_by_list(member, all_fanbox_users)
+                    if change:
+                        role_changes.add(change)
+                    count += 1
+                except AuthException as ex:
+                    raise ex
+                except Exception as ex:
+                    logging.exception(ex)
+        finally:
+            role_changes.flush()
         logging.info(f'End update role check: {count} checked')
 
     async def update_role_check_all_members():
@@ -437,8 +802,7 @@ async def main():
         else:
             await update_role_check_all_members_by_txn()
 
-    async def get_fanbox_role_with_pixiv_id(pixiv_id):
-        user_data = await get_fanbox_user_data(pixiv_id, force_update=True)
+    def role_from_user_data(user_data):
         if config.only_check_current_sub:
             return role_from_supporting_plan(user_data)
         else:
@@ -447,34 +811,86 @@ async def main():
                 role = role_from_supporting_plan(user_data)
             return role
 
-    async def reset():
-        guild = client.guilds[0]
-        count = 0
-        async for member in guild.fetch_members(limit=None):
+    async def get_fanbox_role_with_pixiv_id(pixiv_id):
+        user_data = await get_fanbox_user_data(pixiv_id, force_update=True)
+        return role_from_user_data(user_data)
+
+    # Same checks as the add-user command.
+    async def check_imported_member(member_id, user_data):
+        if await fetch_member(member_id) is None:
+            return 'not_member'
+        if role_from_user_data(user_data) is None:
+            return 'denied'
+        return None
+
+    async def set_imported_member_role(member_id, pixiv_id):
+        member = await fetch_member(member_id)
+        if member is None:
+            return
+        user_data = await get_user_data_db(db, pixiv_id)
+        await set_member_role(member, role_from_user_data(user_data))
+
+    import_lock = asyncio.Lock()
+    loop_profiler = LoopProfiler()
+
+    # Callers must hold import_lock, which also covers queueing rows for the import.
+    async def import_users(progress=None):
+        counts = await run_import(fanbox_client, db, check_access=check_imported_member, on_bound=set_imported_member_role, progress=progress)
+        logging.info(f'Import finished: {counts}')
+        return counts
+
+    async def resume_import():
+        async with import_lock:
+            pending = await get_pending_imports_db(db)
+            if not pending:
+                return
+            logging.info(f'Resuming import: {len(pending)} rows pending')
             try:
-                await member.remove_roles(*config.all_roles)
-            except:
-                pass
-            count += 1
-        await reset_bindings_db(db)
-        return count
+                await import_users()
+            except AuthException:
+                raise
+            except Exception as ex:
+                logging.exception(ex)
+
+    bulk_failures = {}
+
+    async def fetch_bulk_targets(name, predicate, retry):
+        if retry:
+            members = [await fetch_member(member_id) for member_id in bulk_failures.get(name, [])]
+            return [member for member in members if member is not None and predicate(member)]
+        guild = client.guilds[0]
+        return [member async for member in guild.fetch_members(limit=None) if predicate(member)]
+
+    def has_plan_role(member):
+        return has_role(member, config.all_roles)
+
+    async def remove_plan_roles(member):
+        await member.remove_roles(*config.all_roles)
+
+    @timings.timed
+    async def reset(retry=False, dry_run=False, progress=None):
+        targets = await fetch_bulk_targets('reset', has_plan_role, retry)
+        result = await run_guild_operation('reset', targets, remove_plan_roles, bulk_failures, progress, dry_run)
+        if not retry and not dry_run:
+            await reset_bindings_db(db)
+        return result
 
     def is_old_member(joined_at):
         return joined_at + datetime.timedelta(hours=config.cleanup.member_age_hours) <= datetime.datetime.now(joined_at.tzinfo)
 
-    async def purge():
-        guild = client.guilds[0]
-        names = []
-        async for member in guild.fetch_members(limit=None):
-            if len(member.roles) == 1 and is_old_member(member.joined_at):
-                try:
-                    await member.kick(reason="Purge: No role assigned")
-                    names.append(member.name)
-                except:
-                    pass
-        if len(names) > 0:
-            logging.info(f'purged {len(names)} users without roles: {names}')
-        return names
+    def is_purge_target(member):
+        return len(member.roles) == 1 and is_old_member(member.joined_at)
+
+    async def kick_member(member):
+        await member.kick(reason="Purge: No role assigned")
+
+    @timings.timed
+    async def purge(retry=False, dry_run=False, progress=None):
+        targets = await fetch_bulk_targets('purge', is_purge_target, retry)
+        result = await run_guild_operation('purge', targets, kick_member, bulk_failures, progress, dry_run)
+        if result.succeeded and not dry_run:
+            logging.info(f'purged {len(result.succeeded)} users without roles: {[member.name for member in result.succeeded]}')
+        return result
 
     async def cleanup():
         try:
@@ -486,6 +902,7 @@ async def main():
         logging.info(f'User: {message.author}; Message: "{message.content}"; Response: {condition}')
         await message.channel.send(config.system_messages[condition].format(**kwargs))
 
+    @timings.timed
     async def handle_access(message):
         member = await fetch_member(message.author.id)
 
@@ -541,6 +958,30 @@ async def main():
 
         await ctx.send(f'{member} access granted.')
 
+    @client.command(name='import-csv')
+    async def import_csv(ctx):
+        if import_lock.locked():
+            await ctx.send('An import is already running.')
+            return
+        async with import_lock:
+            if ctx.message.attachments:
+                text = (await ctx.message.attachments[0].read()).decode('utf-8-sig')
+                rows = parse_import_csv(text)
+                if not rows:
+                    await ctx.send('No rows with a Pixiv ID and a Discord ID were found in the file.')
+                    return
+                await add_imports_db(db, rows)
+                await ctx.send(f'Queued {len(rows)} rows for import.')
+            else:
+                await retry_import_errors_db(db)
+            status = await ctx.send('Import: starting')
+
+            async def progress(done, total):
+                await status.edit(content=f'Import: {done}/{total} rows processed')
+
+            counts = await import_users(progress)
+        await ctx.send(f'Import finished: {counts}')
+
     @client.command(name='unbind-user-by-discord-id')
     async def unbind_user_by_discord_id(ctx, discord_id):
         pixiv_id = await get_member_pixiv_id_db(db, discord_id)
@@ -571,21 +1012,82 @@ async def main():
         for member_id in member_ids:
             await get_by_discord_id(ctx, member_id)
 
+    async def run_guild_command(ctx, name, func, mode):
+        if mode not in [None, 'dry-run', 'retry']:
+            await ctx.send(f'Usage: `!{name}`, `!{name} dry-run` or `!{name} retry`')
+            return
+        dry_run = mode == 'dry-run'
+        status = await ctx.send(f'{name}: collecting members')
+
+        async def progress(done, total):
+            await status.edit(content=f'{name}: {done}/{total} processed')
+
+        result = await func(retry=mode == 'retry', dry_run=dry_run, progress=progress)
+        summary = f'{name}: {len(result.succeeded)} {"would be affected" if dry_run else "succeeded"}, {len(result.failed)} failed'
+        if result.failed:
+            summary += f'. Use `!{name} retry` to retry the failures.'
+        await status.edit(content=summary)
+
+        # Member lists can exceed Discord's message length limit, so they are sent as a file.
+        lines = [f'{member.name} ({member.id})' for member in result.succeeded]
+        lines += [f'FAILED {member.name} ({member.id}): {ex}' for member, ex in result.failed]
+        if lines:
+            fileobj = io.StringIO('\n'.join(lines))
+            await ctx.send(file=discord.File(fileobj, filename=f'{name}.txt'))
+
     @client.command(name='reset')
-    async def _reset(ctx):
-        count = await reset()
-        await ctx.send(f'removed roles from {count} users')
+    async def _reset(ctx, mode=None):
+        await run_guild_command(ctx, 'reset', reset, mode)
 
     @client.command(name='purge')
-    async def _purge(ctx):
-        names = await purge()
-        await ctx.send(f'purged {len(names)} users without roles: {names}')
+    async def _purge(ctx, mode=None):
+        await run_guild_command(ctx, 'purge', purge, mode)
 
     @client.command(name='test-id')
     async def test_id(ctx, id):
         role = await get_fanbox_role_with_pixiv_id(id)
         await ctx.send(f'Role: {role}')
 
+    @client.command(name='profile')
+    async def profile(ctx, action='start'):
+        if action == 'stop':
+            if not loop_profiler.is_running():
+                await ctx.send('The profiler is not running.')
+                return
+            await ctx.send(file=discord.File(loop_profiler.stop(), filename='profile.txt'))
+            return
+        window = None
+        if action != 'start':
+            try:
+                window = float(action)
+            except ValueError:
+                window = math.nan
+            if not math.isfinite(window) or window <= 0:
+                await ctx.send('Usage: `!profile start`, `!profile stop` or `!profile SECONDS`, where SECONDS is greater than 0')
+                return
+        if loop_profiler.is_running():
+            await ctx.send('The profiler is already running.')
+            return
+        session = loop_profiler.start()
+        if window is None:
+            await ctx.send('Profiler started. Use `!profile stop` to get the report.')
+            return
+        await asyncio.sleep(window)
+        report = loop_profiler.stop(session)
+        if report is None:
+            # Already stopped by `!profile stop`, which sent the report.
+            return
+        await ctx.send(file=discord.File(report, filename='profile.txt'))
+
+    @client.command(name='stats')
+    async def stats(ctx, action=None):
+        if action == 'reset':
+            timings.clear()
+            await ctx.send('Timings cleared.')
+            return
+        report = timings.report() or 'No timings recorded yet.'
+        await ctx.send(f'```\n{report}\n```')
+
     @client.command(name='export-csv')
     async def export_csv(ctx):
         try:
@@ -625,6 +1127,9 @@ async def main():
 
                 if config.auto_role_update.run:
                     tg.create_task(periodic(update_role_check_all_members, config.auto_role_update.period_hours * 60 * 60))
+
+                tg.create_task(resume_import())
+                tg.create_task(monitor_loop_lag())
         except* AuthException as ex:
             await stop_with_exception(ex)
 
@@ -680,7 +1185,52 @@ async def main():
     await asyncio.sleep(delay)
 
 def run_main():
-    asyncio.run(main())
+    config = load_config(config_file)
+    log_listener = setup_logging(config.log_file, config.log_settings)
+    try:
+        asyncio.run(main(config))
+    finally:
+        log_listener.stop()
+
+async def print_import_progress(done, total):
+    print(f'Import: {done}/{total} rows processed')
+
+async def import_from_rows(rows):
+    config = load_config(config_file)
+    client = FanboxClient(config.session_cookies, config.session_headers)
+    db = await open_database()
+    try:
+        if rows:
+            await add_imports_db(db, rows)
+        else:
+            await retry_import_errors_db(db)
+        counts = await run_import(client, db, progress=print_import_progress)
+        print(f'Import finished: {counts}')
+    finally:
+        await db.close()
+
+# Held for the life of the process by the bot, and by the command line import, so that
+# they don't share the database or the Fanbox rate limit. The OS releases it if the process dies.
+def acquire_process_lock():
+    if fcntl is None:
+        return True
+    f = open(lock_file, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+async def cli_import(csv_file=None):
+    rows = None
+    if csv_file is not None:
+        with open(csv_file, 'r', encoding='utf-8-sig') as f:
+            rows = parse_import_csv(f.read())
+        if not rows:
+            print(f'No rows with a Pixiv ID and a Discord ID were found in {csv_file}')
+            return
+    await import_from_rows(rows)
 
 async def db_migration():
     import pickle
@@ -690,27 +1240,22 @@ async def db_migration():
     print('Found registry.dat: Starting DB migration')
     with open('registry.dat', 'rb') as f:
         reg = pickle.load(f)
-    config = load_config(config_file)
-    client = FanboxClient(config.session_cookies, config.session_headers)
-    db = await open_database()
-    for discord_id, pixiv_ids in reg['discord_ids'].items():
-        for pixiv_id in pixiv_ids:
-            try:
-                user_data = await client.get_user(pixiv_id)
-            except:
-                continue
-            if user_data is None:
-                continue
-            print(f'user {discord_id} {pixiv_id}')
-            await update_member_pixiv_id_db(db, discord_id, pixiv_id)
-            await update_user_data_db(db, pixiv_id, user_data)
-            break
-    await db.close()
+    rows = [(discord_id, int(pixiv_id)) for discord_id, pixiv_ids in reg['discord_ids'].items() for pixiv_id in pixiv_ids]
+    await import_from_rows(rows)
     os.rename('registry.dat', 'registry.dat.backup')
     print('Moved registry.dat to registry.dat.backup')
     print('DB migration finished')
 
 if __name__ == '__main__':
+    process_lock = acquire_process_lock()
+    if process_lock is None:
+        print(f'Another bot or import process is running (locked {lock_file}). Stop it first.')
+        sys.exit(1)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        asyncio.run(cli_import(sys.argv[2] if len(sys.argv) > 2 else None))
+        sys.exit()
+
     asyncio.run(db_migration())
 
     with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
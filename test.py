@@ -1,5 +1,14 @@
 import main
+import asyncio
+import calendar
+import datetime
+import itertools
+import json
 import logging
+import random
+import time
+
+import pytest
 
 logging.basicConfig(
     format='[%(asctime)s][%(levelname)s] %(message)s',
@@ -42,5 +51,514 @@ current_date = main.parse_date('2024-06-01T00:00:01+09:00')
 
 test_txns = filter_future_dates(test_txns, current_date)
 
-print(main.compute_plan_id(test_txns, test_plan_fee_lookup, current_date, 5, True))
-print(main.compute_highest_plan_id(test_txns, test_plan_fee_lookup))
\ No newline at end of file
+def test_fixture():
+    assert main.compute_plan_id(test_txns, test_plan_fee_lookup, current_date, 5, True) == '1'
+    assert main.compute_highest_plan_id(test_txns, test_plan_fee_lookup) == '2'
+
+def read_log_lines(tmp_path, json_output):
+    log_file = tmp_path / 'log.txt'
+    log_settings = main.obj(main.default_log_settings | {'json': json_output})
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    listener = main.setup_logging(str(log_file), log_settings)
+    try:
+        logging.info('hello %s', 'world')
+        try:
+            1 / 0
+        except ZeroDivisionError as ex:
+            logging.exception(ex)
+    finally:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        root.handlers[:] = handlers
+        root.setLevel(level)
+    return log_file.read_text(encoding='utf-8').splitlines()
+
+def test_logging_plain(tmp_path):
+    lines = read_log_lines(tmp_path, False)
+    assert lines[0].endswith('][INFO] hello world')
+    assert lines[1].endswith('][ERROR] division by zero')
+    assert lines[2] == 'Traceback (most recent call last):'
+
+def test_logging_json(tmp_path):
+    info, error = [json.loads(line) for line in read_log_lines(tmp_path, True)]
+    assert info['level'] == 'INFO'
+    assert info['message'] == 'hello world'
+    assert 'exception' not in info
+    assert error['level'] == 'ERROR'
+    assert error['message'] == 'division by zero'
+    assert error['exception'].startswith('Traceback (most recent call last):')
+
+def test_parse_import_csv():
+    text = '\n'.join([
+        'pixiv_id,discord_id',
+        'pixiv_id_2,discord_id',
+        '11,100',
+        ' 12 , 200 ',
+        'https://www.pixiv.net/users/13,300',
+        'https://www.pixiv.net/en/users/14/,400',
+        'pixiv.net/users/15,500',
+        'user42,12',
+        '16,user 600',
+        'https://example.com/users/17,700',
+        '18',
+        '',
+    ])
+    assert main.parse_import_csv(text) == [(100, 11), (200, 12), (300, 13), (400, 14), (500, 15)]
+
+class FakeFanboxClient:
+    def __init__(self, users, errors=(), error_type=RuntimeError):
+        self.users = users
+        self.errors = set(errors)
+        self.error_type = error_type
+        self.calls = []
+
+    async def get_user(self, pixiv_id):
+        self.calls.append(pixiv_id)
+        if pixiv_id in self.errors:
+            raise self.error_type(f'failed {pixiv_id}')
+        return self.users.get(pixiv_id)
+
+def fake_user(pixiv_id):
+    return {'user': {'userId': str(pixiv_id)}, 'supportTransactions': []}
+
+async def query_import(db):
+    cursor = await db.execute('select member_id, pixiv_id, status from import_queue order by id')
+    return await cursor.fetchall()
+
+async def query_bindings(db):
+    cursor = await db.execute('select member_id, pixiv_id from member_pixiv order by member_id')
+    return await cursor.fetchall()
+
+def test_run_import():
+    async def run():
+        db = await main.open_database(':memory:')
+        client = FakeFanboxClient({1: fake_user(1), 2: fake_user(2), 4: fake_user(4)}, errors=[3])
+        bound = []
+
+        async def on_bound(member_id, pixiv_id):
+            bound.append((member_id, pixiv_id))
+
+        rows = [
+            (100, 9), # Not on Fanbox, so the next pixiv_id for this member is tried.
+            (100, 1),
+            (100, 2), # Member already bound to the first valid pixiv_id.
+            (200, 1), # Same pixiv_id for another member is only fetched once.
+            (300, 3), # Fetch error.
+            (400, 4),
+        ]
+        await main.add_imports_db(db, rows + [(100, 1)])
+        counts = await main.run_import(client, db, on_bound=on_bound, batch_size=4)
+        assert sorted(client.calls) == [1, 2, 3, 4, 9]
+        assert await query_import(db) == [
+            (100, 9, 'not_found'),
+            (100, 1, 'bound'),
+            (100, 2, 'skipped'),
+            (200, 1, 'bound'),
+            (300, 3, 'error'),
+            (400, 4, 'bound'),
+        ]
+        assert counts == {'not_found': 1, 'bound': 3, 'skipped': 1, 'error': 1}
+        assert await query_bindings(db) == [(100, 1), (200, 1), (400, 4)]
+        assert bound == [(100, 1), (200, 1), (400, 4)]
+        assert await main.get_user_data_db(db, 4) == fake_user(4)
+
+        # Retrying only fetches the rows that failed.
+        client.errors.clear()
+        client.users[3] = fake_user(3)
+        client.calls.clear()
+        await main.retry_import_errors_db(db)
+        await main.run_import(client, db)
+        assert client.calls == [3]
+        assert (300, 3) in await query_bindings(db)
+        await db.close()
+
+    asyncio.run(run())
+
+def test_run_import_check_access():
+    async def run():
+        db = await main.open_database(':memory:')
+        client = FakeFanboxClient({1: fake_user(1), 2: fake_user(2), 3: fake_user(3)})
+
+        async def check_access(member_id, user_data):
+            if member_id == 300:
+                return 'not_member'
+            if user_data['user']['userId'] == '1':
+                return 'denied'
+            return None
+
+        await main.add_imports_db(db, [(100, 1), (100, 2), (300, 3)])
+        await main.run_import(client, db, check_access=check_access)
+        assert await query_import(db) == [(100, 1, 'denied'), (100, 2, 'bound'), (300, 3, 'not_member')]
+        assert await query_bindings(db) == [(100, 2)]
+        await db.close()
+
+    asyncio.run(run())
+
+def test_run_import_resumes_after_auth_error():
+    async def run():
+        db = await main.open_database(':memory:')
+        client = FakeFanboxClient({pixiv_id: fake_user(pixiv_id) for pixiv_id in range(1, 7)}, errors=[4], error_type=main.AuthException)
+        await main.add_imports_db(db, [(pixiv_id * 100, pixiv_id) for pixiv_id in range(1, 7)])
+        with pytest.raises(main.AuthException):
+            await main.run_import(client, db, batch_size=3)
+        # The first batch was committed, the rest is still pending.
+        assert [row[2] for row in await query_import(db)] == ['bound'] * 3 + [None] * 3
+
+        client.errors.clear()
+        client.calls.clear()
+        # Queueing the same rows again resumes the pending job instead of restarting it.
+        await main.add_imports_db(db, [(pixiv_id * 100, pixiv_id) for pixiv_id in range(1, 7)])
+        await main.run_import(client, db, batch_size=3)
+        assert sorted(client.calls) == [4, 5, 6]
+        assert [row[2] for row in await query_import(db)] == ['bound'] * 6
+        await db.close()
+
+    asyncio.run(run())
+
+class FakeMember:
+    def __init__(self, id):
+        self.id = id
+
+    def __str__(self):
+        return f'member{self.id}'
+
+def test_run_bulk_operation():
+    active = 0
+    max_active = 0
+    progress_calls = []
+
+    async def operation(member):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.001)
+        active -= 1
+        if member.id % 3 == 0:
+            raise RuntimeError(f'failed {member.id}')
+
+    async def progress(done, total):
+        progress_calls.append((done, total))
+
+    targets = [FakeMember(i) for i in range(10)]
+    result = asyncio.run(main.run_bulk_operation(targets, operation, concurrency=3, progress=progress))
+    assert max_active == 3
+    assert sorted(member.id for member in result.succeeded) == [1, 2, 4, 5, 7, 8]
+    assert sorted(member.id for member, _ in result.failed) == [0, 3, 6, 9]
+    assert all(isinstance(ex, RuntimeError) for _, ex in result.failed)
+    assert result.done() == 10
+    assert progress_calls[-1] == (10, 10)
+
+def test_run_bulk_operation_empty():
+    progress_calls = []
+
+    async def operation(member):
+        raise AssertionError('no targets')
+
+    async def progress(done, total):
+        progress_calls.append((done, total))
+
+    result = asyncio.run(main.run_bulk_operation([], operation, progress=progress))
+    assert result.succeeded == []
+    assert result.failed == []
+    assert progress_calls[-1] == (0, 0)
+
+def test_run_guild_operation():
+    calls = []
+
+    async def operation(member):
+        calls.append(member.id)
+        if member.id == 2:
+            raise RuntimeError('failed')
+
+    targets = [FakeMember(i) for i in range(4)]
+    failures = {}
+    result = asyncio.run(main.run_guild_operation('purge', targets, operation, failures, dry_run=True))
+    assert calls == []
+    assert result.succeeded == targets
+    assert failures == {}
+
+    result = asyncio.run(main.run_guild_operation('purge', targets, operation, failures))
+    assert sorted(calls) == [0, 1, 2, 3]
+    assert failures == {'purge': [2]}
+
+# Generator of realistic transaction histories, newest first like the Fanbox API returns them.
+
+jst = datetime.timezone(datetime.timedelta(hours=9))
+plan_fees = sorted(test_plan_fee_lookup.keys())
+# Fees of plans that were deleted from Fanbox, so they are missing from the plan fee lookup.
+deleted_plan_fees = [300, 700]
+
+def make_txn(fee, date):
+    return {
+        'paidAmount': fee,
+        'transactionDatetime': date.isoformat(),
+        'targetMonth': f'{date.year}-{date.month:02}',
+    }
+
+def next_month(year, month):
+    if month == 12:
+        return year + 1, 1
+    return year, month + 1
+
+def random_time(rng):
+    # Fanbox reports times in JST, so payments just around midnight land in a different
+    # UTC day, and at the start or end of a month, a different UTC month.
+    return rng.choice([(0, 0), (0, 30), (9, 0), (12, 0), (23, 59)])
+
+def previous_month(year, month):
+    if month == 1:
+        return year - 1, 12
+    return year, month - 1
+
+def generate_history(rng, months, changes=True, deleted_plans=True, refunds=True, start=(2015, 1)):
+    txns = []
+    year, month = start
+    fee = rng.choice(plan_fees)
+    for _ in range(months):
+        month_days = calendar.monthrange(year, month)[1]
+        event = rng.random() if changes else 1
+        if event < 0.1:
+            # Gap: no payment for this month.
+            year, month = next_month(year, month)
+            continue
+        if event < 0.2:
+            # Upgrade or downgrade at renewal.
+            fee = rng.choice(plan_fees)
+        elif event < 0.25 and deleted_plans:
+            # Renewed on a plan that has since been deleted.
+            fee = rng.choice(deleted_plan_fees)
+        # Most renewals happen at the start of the month, the rest start mid-month.
+        day = min(rng.choice([1, 1, 1, 2, 5, 15, 28, 31]), month_days)
+        date = datetime.datetime(year, month, day, *random_time(rng), tzinfo=jst)
+        txns.append(make_txn(fee, date))
+        if day < month_days:
+            later_date = date.replace(day=rng.randint(day + 1, month_days))
+            extra = rng.random() if changes else 1
+            higher_fees = [f for f in plan_fees if f > fee]
+            lower_fees = [f for f in plan_fees if f < fee]
+            if extra < 0.1 and higher_fees:
+                # Mid-month upgrade: only the difference is paid.
+                new_fee = rng.choice(higher_fees)
+                txns.append(make_txn(new_fee - fee, later_date))
+                fee = new_fee
+            elif extra < 0.15 and lower_fees:
+                # Mid-month downgrade: the difference is refunded.
+                new_fee = rng.choice(lower_fees)
+                txns.append(make_txn(new_fee - fee, later_date))
+                fee = new_fee
+            elif extra < 0.2 and refunds:
+                # Refund of this month's payment.
+                txns.append(make_txn(-fee, later_date))
+        year, month = next_month(year, month)
+    txns.reverse()
+    return txns
+
+def latest_date(txns):
+    return main.parse_date(txns[0]['transactionDatetime'])
+
+def random_current_date(rng, txns, leeway_days):
+    date = latest_date(txns)
+    if rng.random() < 0.5:
+        return date + datetime.timedelta(days=rng.randint(0, 70), minutes=rng.randint(0, 24 * 60))
+    # Around the leeway period at the start of a month, in both JST and UTC.
+    year, month = next_month(date.year, date.month)
+    tz = rng.choice([jst, datetime.timezone.utc])
+    month_start = datetime.datetime(year, month, 1, tzinfo=tz)
+    offset = datetime.timedelta(days=leeway_days, minutes=rng.choice([-1, 0, 1]))
+    return month_start + offset
+
+def random_histories(count, max_months=120, **kwargs):
+    rng = random.Random(12345)
+    for _ in range(count):
+        txns = generate_history(rng, rng.randint(1, max_months), **kwargs)
+        if txns:
+            yield rng, txns
+
+# Property tests
+
+def test_compress_preserves_total_fee():
+    for _, txns in random_histories(200):
+        compressed = main.compress_transactions(txns)
+        assert sum(txn['fee'] for txn in compressed) == sum(txn['paidAmount'] for txn in txns)
+
+def test_compress_one_entry_per_month():
+    for _, txns in random_histories(200):
+        compressed = main.compress_transactions(txns)
+        assert len(compressed) == len({txn['targetMonth'] for txn in txns})
+        for txn in compressed:
+            assert txn['deltatime'] == main.days_in_month(txn['date'])
+
+def test_last_subscription_range():
+    for _, txns in random_histories(200):
+        compressed = main.compress_transactions(txns)
+        txn_range, stop_date = main.compute_last_subscription_range(compressed)
+        assert txn_range
+        # The range always ends with the latest transaction, in date order.
+        assert txn_range[-1] is compressed[0]
+        assert all(a['date'] < b['date'] for a, b in itertools.pairwise(txn_range))
+        # Overflow days are carried over, so the range covers exactly a month per transaction.
+        assert stop_date == txn_range[0]['date'] + sum((txn['deltatime'] for txn in txn_range), datetime.timedelta())
+
+plan_id_fees = {v: k for k, v in test_plan_fee_lookup.items()}
+
+def check_plan_id_from_fees(plan_id, fees):
+    # The plan must be paid for by one of the fees, and when there is only one fee, it must be that fee's plan.
+    if plan_id is not None:
+        assert plan_id_fees[plan_id] in fees
+    if len(fees) == 1:
+        assert plan_id == test_plan_fee_lookup.get(next(iter(fees)))
+
+def test_plan_id_from_last_subscription_range():
+    for rng, txns in random_histories(300):
+        leeway_days = rng.randint(0, 7)
+        date = random_current_date(rng, txns, leeway_days)
+        txn_range, stop_date = main.compute_last_subscription_range(main.compress_transactions(txns))
+        plan_id = main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, False)
+        if date > stop_date + datetime.timedelta(days=leeway_days):
+            assert plan_id is None
+        else:
+            check_plan_id_from_fees(plan_id, {txn['fee'] for txn in txn_range})
+
+def calendar_month_start(date, months_back=0):
+    year, month = date.year, date.month
+    for _ in range(months_back):
+        year, month = previous_month(year, month)
+    return datetime.datetime(year, month, 1, tzinfo=date.tzinfo)
+
+def test_plan_id_limited_range_uses_current_month():
+    # With only known plan fees, a payment in the current calendar month always grants a plan,
+    # and when it's the only payment since the start of the previous month, it's that payment's plan.
+    checked = 0
+    for rng, txns in random_histories(300, deleted_plans=False, refunds=False):
+        leeway_days = rng.randint(0, 7)
+        date = random_current_date(rng, txns, leeway_days)
+        compressed = main.compress_transactions(txns)
+        current = [txn for txn in compressed if calendar_month_start(date) <= txn['date'] <= date]
+        if not current:
+            continue
+        checked += 1
+        plan_id = main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, True)
+        assert plan_id is not None
+        recent = [txn for txn in compressed if calendar_month_start(date, 1) <= txn['date'] <= date]
+        if len(recent) == 1:
+            assert plan_id == test_plan_fee_lookup[recent[0]['fee']]
+    assert checked > 0
+
+def test_plan_id_limited_range_ignores_older_months():
+    # Payments before the previous calendar month never count, whatever leeway_days is.
+    for rng, txns in random_histories(300):
+        leeway_days = rng.randint(0, 40)
+        date = random_current_date(rng, txns, min(leeway_days, 7))
+        fees = {txn['fee'] for txn in main.compress_transactions(txns) if calendar_month_start(date, 1) <= txn['date'] <= date}
+        plan_id = main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, True)
+        if not fees:
+            assert plan_id is None
+        elif plan_id is not None:
+            assert plan_id_fees[plan_id] in fees
+
+def test_plan_id_none_after_lapse():
+    for rng, txns in random_histories(200):
+        leeway_days = rng.randint(0, 7)
+        _, stop_date = main.compute_last_subscription_range(main.compress_transactions(txns))
+        date = stop_date + datetime.timedelta(days=leeway_days, seconds=1)
+        assert main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, False) is None
+
+def test_plan_id_constant_fee():
+    for rng, txns in random_histories(200, changes=False):
+        fee = txns[0]['paidAmount']
+        leeway_days = rng.randint(0, 7)
+        _, stop_date = main.compute_last_subscription_range(main.compress_transactions(txns))
+        date = rng.choice([latest_date(txns), stop_date, stop_date + datetime.timedelta(days=leeway_days)])
+        assert main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, False) == test_plan_fee_lookup[fee]
+
+def test_plan_id_limited_range_ignores_old_txns():
+    for rng, txns in random_histories(200):
+        leeway_days = rng.randint(0, 7)
+        # Two full months after the latest transaction, nothing is recent enough.
+        date = latest_date(txns) + datetime.timedelta(days=62 + leeway_days)
+        assert main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, True) is None
+
+def test_plan_id_naive_current_date_is_utc():
+    for rng, txns in random_histories(100):
+        leeway_days = rng.randint(0, 7)
+        date = random_current_date(rng, txns, leeway_days).astimezone(datetime.timezone.utc)
+        naive = date.replace(tzinfo=None)
+        for limit_txn_range in [False, True]:
+            expected = main.compute_plan_id(txns, test_plan_fee_lookup, date, leeway_days, limit_txn_range)
+            assert main.compute_plan_id(txns, test_plan_fee_lookup, naive, leeway_days, limit_txn_range) == expected
+
+def monthly_fees(txns):
+    fees = {}
+    for txn in txns:
+        fees[txn['targetMonth']] = fees.get(txn['targetMonth'], 0) + txn['paidAmount']
+    return fees
+
+def test_highest_plan_id_without_deleted_plans():
+    # Upgrades and downgrades only move between known plans, so the highest month is a known plan.
+    for _, txns in random_histories(200, deleted_plans=False, refunds=False):
+        highest = max(monthly_fees(txns).values())
+        assert main.compute_highest_plan_id(txns, test_plan_fee_lookup) == test_plan_fee_lookup[highest]
+
+def test_highest_plan_id_ignores_order_within_month():
+    for rng, txns in random_histories(200):
+        shuffled = []
+        for _, group in itertools.groupby(txns, lambda txn: txn['targetMonth']):
+            group = list(group)
+            rng.shuffle(group)
+            shuffled += group
+        expected = main.compute_highest_plan_id(txns, test_plan_fee_lookup)
+        assert main.compute_highest_plan_id(shuffled, test_plan_fee_lookup) == expected
+
+# Benchmarks
+# Uses pytest-benchmark when it is installed, otherwise a minimal timer with the same interface.
+
+try:
+    import pytest_benchmark
+except ImportError:
+    @pytest.fixture
+    def benchmark(request, capsys):
+        def run(func, *args, **kwargs):
+            rounds = []
+            for _ in range(20):
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                rounds.append(time.perf_counter() - start)
+            # Written past pytest's output capture, so the timings show up without -s.
+            with capsys.disabled():
+                print(f'\n{request.node.name}: min {min(rounds) * 1e6:.1f}us, mean {sum(rounds) / len(rounds) * 1e6:.1f}us', end='')
+            return result
+        return run
+
+benchmark_months = [1, 12, 24, 60, 120]
+
+@pytest.fixture
+def quiet_logging():
+    # compute_plan_id logs at debug level, which would dominate the timings.
+    logging.disable(logging.DEBUG)
+    yield
+    logging.disable(logging.NOTSET)
+
+def benchmark_history(months):
+    return generate_history(random.Random(months), months, changes=months > 1)
+
+@pytest.mark.parametrize('months', benchmark_months)
+def test_benchmark_compress_transactions(benchmark, quiet_logging, months):
+    txns = benchmark_history(months)
+    benchmark(main.compress_transactions, txns)
+
+@pytest.mark.parametrize('months', benchmark_months)
+def test_benchmark_compute_last_subscription_range(benchmark, quiet_logging, months):
+    txns = main.compress_transactions(benchmark_history(months))
+    benchmark(main.compute_last_subscription_range, txns)
+
+@pytest.mark.parametrize('limit_txn_range', [False, True])
+@pytest.mark.parametrize('months', benchmark_months)
+def test_benchmark_compute_plan_id(benchmark, quiet_logging, months, limit_txn_range):
+    txns = benchmark_history(months)
+    date = latest_date(txns) + datetime.timedelta(days=3)
+    benchmark(main.compute_plan_id, txns, test_plan_fee_lookup, date, 5, limit_txn_range)
+
+if __name__ == '__main__':
+    pytest.main([__file__])